@@ -3,54 +3,479 @@
 # Modified by Jitesh Jain (https://github.com/praeclarumjj3)
 # ------------------------------------------------------------------------------
 
-import copy
 import logging
 
+import cv2
 import numpy as np
+import shapely
+import shapely.geometry
 import torch
+from torch.utils.data import get_worker_info
 
 from detectron2.data import MetadataCatalog
 from detectron2.config import configurable
 from detectron2.data import detection_utils as utils
 from detectron2.data import transforms as T
+from detectron2.structures import Boxes, BoxMode, Instances, PolygonMasks
 from oneformer.data.tokenizer import SimpleTokenizer, Tokenize
 from pycocotools import mask as coco_mask
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 __all__ = ["InstanceCOCOCustomNewBaselineDatasetMapper"]
 
 
+def _rle_string_to_counts(counts):
+    """将pycocotools压缩后的RLE字符串解码为游程长度数组（NumPy向量化实现，等价于C代码中的rleFrString）。
+    每个字符携带5位数据，0x20为续位，最后一个字符的0x10为符号位；下标大于2的游程以m-2处的游程为基准做差分编码。
+    """
+    if isinstance(counts, str):
+        counts = counts.encode("ascii")
+    chars = np.frombuffer(counts, dtype=np.uint8).astype(np.int64) - 48
+    ends = (chars & 0x20) == 0
+    starts = np.flatnonzero(np.concatenate(([True], ends[:-1])))
+    group = np.cumsum(np.concatenate(([0], ends[:-1].astype(np.int64))))
+    shift = 5 * (np.arange(len(chars)) - starts[group])
+    runs = np.add.reduceat(np.left_shift(chars & 0x1F, shift), starts)
+    last = np.flatnonzero(ends)
+    negative = (chars[last] & 0x10) != 0
+    runs[negative] -= np.left_shift(1, shift[last[negative]] + 5)
+    runs[1::2] = np.cumsum(runs[1::2])
+    runs[2::2] = np.cumsum(runs[2::2])
+    return runs
+
+
+def _rle_to_mask(rle):
+    """将单个RLE展开为（H, W）的uint8二进制掩码。游程从0开始交替，且按列优先（Fortran）顺序排列。"""
+    height, width = rle["size"]
+    runs = _rle_string_to_counts(rle["counts"])
+    ones_zeros = (np.arange(len(runs)) % 2).astype(np.uint8)
+    return np.repeat(ones_zeros, runs).reshape(width, height).T
+
+
+# 实例的边界框宽度小于图像宽度的该比例时，只在边界框所覆盖的列内光栅化，而不解码整幅图像大小的RLE
+_NARROW_OBJECT_WIDTH_RATIO = 0.25
+
+
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _poly_boundary_points(xy, h, w):
+        """
+        逐行移植pycocotools中rleFrPoly的边界点计算：放大5倍后沿多边形边界稠密采样，再下采样得到每列的翻转点。
+        返回的(x, y)表示在按列优先展开的掩码中，从位置x * h + y开始像素值翻转（y可能等于h）。
+        """
+        scale = 5.0
+        k = len(xy) // 2
+        x = np.empty(k + 1, dtype=np.int64)
+        y = np.empty(k + 1, dtype=np.int64)
+        for j in range(k):
+            x[j] = int(scale * xy[2 * j] + 0.5)
+            y[j] = int(scale * xy[2 * j + 1] + 0.5)
+        x[k] = x[0]
+        y[k] = y[0]
+        m = 0
+        for j in range(k):
+            m += max(abs(x[j] - x[j + 1]), abs(y[j] - y[j + 1])) + 1
+        u = np.empty(m, dtype=np.int64)
+        v = np.empty(m, dtype=np.int64)
+        m = 0
+        for j in range(k):
+            xs, xe, ys, ye = x[j], x[j + 1], y[j], y[j + 1]
+            dx, dy = abs(xe - xs), abs(ys - ye)
+            flip = (dx >= dy and xs > xe) or (dx < dy and ys > ye)
+            if flip:
+                xs, xe, ys, ye = xe, xs, ye, ys
+            if dx == 0 and dy == 0:
+                s = 0.0
+            elif dx >= dy:
+                s = (ye - ys) / dx
+            else:
+                s = (xe - xs) / dy
+            if dx >= dy:
+                for d in range(dx + 1):
+                    t = dx - d if flip else d
+                    u[m] = t + xs
+                    v[m] = int(ys + s * t + 0.5)
+                    m += 1
+            else:
+                for d in range(dy + 1):
+                    t = dy - d if flip else d
+                    v[m] = t + ys
+                    u[m] = int(xs + s * t + 0.5)
+                    m += 1
+        px = np.empty(m, dtype=np.int64)
+        py = np.empty(m, dtype=np.int64)
+        n = 0
+        for j in range(1, m):
+            if u[j] == u[j - 1]:
+                continue
+            xd = float(u[j] if u[j] < u[j - 1] else u[j] - 1)
+            xd = (xd + 0.5) / scale - 0.5
+            if np.floor(xd) != xd or xd < 0 or xd > w - 1:
+                continue
+            yd = float(v[j] if v[j] < v[j - 1] else v[j - 1])
+            yd = (yd + 0.5) / scale - 0.5
+            if yd < 0:
+                yd = 0.0
+            elif yd > h:
+                yd = float(h)
+            px[n] = int(xd)
+            py[n] = int(np.ceil(yd))
+            n += 1
+        return px[:n], py[:n]
+
+    @numba.njit(cache=True)
+    def _rasterize_polys_in_columns(polys_flat, offsets, h, w):
+        """
+        只在多边形覆盖的列内按与pycocotools相同的规则光栅化，多个多边形之间取并集（等价于coco_mask.merge）。
+        每列多分配一行，用于存放y == h处（即下一列起始处）的翻转点，使列优先展开后的翻转顺序与整幅图像一致。
+        args:
+            polys_flat: (2M,) float64 所有多边形顶点拼接后的坐标 [x0, y0, x1, y1, ...]
+            offsets: (P+1,) int64 每个多边形在顶点序列中的起始位置
+        returns:
+            x0: 第一列的列号
+            mask: (w_cols, h) uint8 列优先的局部掩码
+            ok: 若某个多边形翻转次数为奇数（填充会延伸到这些列之外），返回False，由调用方回退到pycocotools
+        """
+        num_polys = len(offsets) - 1
+        xs = []
+        ys = []
+        x0, x1 = w, -1
+        for k in range(num_polys):
+            px, py = _poly_boundary_points(polys_flat[2 * offsets[k] : 2 * offsets[k + 1]], h, w)
+            xs.append(px)
+            ys.append(py)
+            if len(px):
+                x0 = min(x0, px.min())
+                x1 = max(x1, px.max())
+        if x1 < x0:
+            return 0, np.zeros((0, h), dtype=np.uint8), True
+        mask = np.zeros((x1 - x0 + 1, h + 1), dtype=np.uint8)
+        toggles = np.empty_like(mask)
+        for k in range(num_polys):
+            toggles[:] = 0
+            px, py = xs[k], ys[k]
+            for j in range(len(px)):
+                toggles[px[j] - x0, py[j]] ^= 1
+            state = 0
+            for c in range(mask.shape[0]):
+                for r in range(h + 1):
+                    state ^= toggles[c, r]
+                    mask[c, r] |= state
+            if state:
+                return 0, mask[:, :h], False
+        return x0, mask[:, :h], True
+
+else:
+    _rasterize_polys_in_columns = None
+
+
 def convert_coco_poly_to_mask(segmentations, height, width):
     """
     args:
         segmentations: list[list[list[float]]] 多边形分割列表
         height, width: the size of the resulting mask.
     """
-    masks = []
-    for polygons in segmentations:
-        """对于每个多边形分割，函数首先使用coco_mask.frPyObjects方法将其转换为RLE
+    """预先分配(N, height, width)的掩码数组，每个实例的结果直接写入对应位置，省去最后的np.stack拷贝。"""
+    masks = np.zeros((len(segmentations), height, width), dtype=np.uint8)
+    boxes = polygons_to_boxes(segmentations)
+    for i, polygons in enumerate(segmentations):
+        if not len(polygons):
+            continue
+        """对于窄目标（边界框宽度不足图像的_NARROW_OBJECT_WIDTH_RATIO），若numba可用，
+        只在其覆盖的列内按与pycocotools相同的规则光栅化，结果与coco_mask完全一致，
+        同时避免为每个实例编码、解码整幅图像大小的RLE。"""
+        narrow = boxes[i, 2] - boxes[i, 0] + 2 < _NARROW_OBJECT_WIDTH_RATIO * width
+        if _rasterize_polys_in_columns is not None and narrow:
+            polys_flat = np.concatenate(polygons).astype(np.float64)
+            offsets = np.cumsum([0] + [len(p) // 2 for p in polygons]).astype(np.int64)
+            x0, columns, ok = _rasterize_polys_in_columns(polys_flat, offsets, height, width)
+            if ok:
+                masks[i, :, x0 : x0 + columns.shape[0]] = columns.T
+                continue
+        """对于其他实例，函数首先使用coco_mask.frPyObjects方法将其全部多边形转换为RLE
         （Run-Length Encoding，行程长度编码）格式，
-        然后使用coco_mask.decode方法将RLE格式的分割解码为二进制掩码。"""
-        rles = coco_mask.frPyObjects(polygons, height, width)
-        mask = coco_mask.decode(rles)
-        """接下来，函数检查解码后的掩码的维度。
-        如果掩码的维度少于3（即，掩码是一个二维数组），函数将在最后一个维度上添加一个新的维度。
-        这是因为我们需要一个三维的掩码，其中第一维表示不同的分割，第二和第三维表示图像的高度和宽度。"""
-        if len(mask.shape) < 3:
-            mask = mask[..., None]
-        """然后，函数将掩码转换为torch.Tensor类型，并将其数据类型设置为torch.uint8。
-        这是因为我们需要一个由0和1组成的二进制掩码，而torch.uint8类型可以有效地存储这样的数据。"""
-        mask = torch.as_tensor(mask, dtype=torch.uint8)
-        """函数使用any方法将掩码在第三个维度上进行逻辑或运算，得到一个二维的掩码。
+        然后使用coco_mask.merge在C层面对多个多边形做逻辑或运算，合并为一个RLE，
+        最后用_rle_to_mask通过np.repeat一次性展开游程，直接得到一个二维（H, W）的二进制掩码。
         这是因为在COCO数据集中，一个物体可能有多个分割，我们需要将这些分割合并为一个掩码。"""
-        mask = mask.any(dim=2)
-        masks.append(mask)
-    """如果masks列表不为空，函数使用torch.stack方法将列表中的所有掩码堆叠在一起，得到一个三维的Tensor；
-    如果masks列表为空，函数使用torch.zeros方法创建一个形状为(0, height, width)的零Tensor。"""
-    if masks:
-        masks = torch.stack(masks, dim=0)
+        rles = coco_mask.frPyObjects(polygons, height, width)
+        rle = coco_mask.merge(rles)
+        masks[i] = _rle_to_mask(rle)
+    """最后一次性转换为torch.uint8类型的三维Tensor；实例为空时即为形状(0, height, width)的零Tensor。"""
+    return torch.from_numpy(masks)
+
+
+class AffineCropTransform(T.Transform):
+    """
+    用一个2x3仿射矩阵描述缩放与裁剪（含填充）的复合变换，放大时图像只做一次cv2.warpAffine插值，
+    不再产生“先缩放、再裁剪和填充”的中间图像。
+    缩小时双线性的warpAffine只读取最近的4个像素，会产生混叠，因此先用cv2.INTER_AREA缩小到目标尺寸
+    （与ResizeScale中PIL缩小时的平滑效果一致），再用剩余的平移/翻转矩阵做裁剪和填充。
+    矩阵作用于连续坐标（像素i覆盖区间[i, i+1)），与detectron2中apply_coords的约定一致。
+    """
+
+    def __init__(
+        self, matrix, input_h, input_w, scaled_h, scaled_w, output_h, output_w, pad_value=128.0, seg_pad_value=0
+    ):
+        """
+        Args:
+            matrix (ndarray): 2x3仿射矩阵，将输入图像的连续坐标映射到输出图像。
+            input_h, input_w (int): 输入图像尺寸。
+            scaled_h, scaled_w (int): 缩放后（裁剪前）的图像尺寸。
+            output_h, output_w (int): 输出图像尺寸。
+            pad_value (float): 图像填充值，与FixedSizeCrop保持一致。
+            seg_pad_value (int): 分割图填充值，与FixedSizeCrop保持一致。
+        """
+        super().__init__()
+        self._set_attributes(locals())
+
+    def _warp(self, img, matrix, interp, border_value):
+        # cv2采用像素中心坐标，需要将连续坐标下的矩阵平移半个像素
+        matrix = matrix.copy()
+        matrix[:, 2] += matrix[:, :2].sum(axis=1) * 0.5 - 0.5
+        ret = cv2.warpAffine(
+            img,
+            matrix,
+            (self.output_w, self.output_h),
+            flags=interp,
+            borderMode=cv2.BORDER_CONSTANT,
+            borderValue=(border_value,) * 4,
+        )
+        if img.ndim == 3 and ret.ndim == 2:
+            ret = ret[:, :, None]
+        return ret
+
+    def apply_image(self, img, interp=cv2.INTER_LINEAR):
+        if self.scaled_h >= self.input_h and self.scaled_w >= self.input_w:
+            return self._warp(img, self.matrix, interp, self.pad_value)
+        # 缩小：先INTER_AREA缩放，剩余矩阵只包含翻转与整数裁剪偏移
+        resized = cv2.resize(img, (self.scaled_w, self.scaled_h), interpolation=cv2.INTER_AREA)
+        if img.ndim == 3 and resized.ndim == 2:
+            resized = resized[:, :, None]
+        matrix = self.matrix.copy()
+        matrix[:, 0] *= self.input_w / self.scaled_w
+        matrix[:, 1] *= self.input_h / self.scaled_h
+        return self._warp(resized, matrix, interp, self.pad_value)
+
+    def apply_segmentation(self, segmentation):
+        # 最近邻插值不存在混叠问题，始终一次完成
+        return self._warp(segmentation, self.matrix, cv2.INTER_NEAREST, self.seg_pad_value)
+
+    def apply_coords(self, coords):
+        coords = np.asarray(coords, dtype=np.float64)
+        return coords @ self.matrix[:, :2].T + self.matrix[:, 2]
+
+    def apply_polygons(self, polygons):
+        # 与transform_annotations_to_instances一致：变换后裁剪到输出图像范围内
+        polygons = [self.apply_coords(p) for p in polygons]
+        return T.CropTransform(0, 0, self.output_w, self.output_h).apply_polygons(polygons)
+
+
+class ResizeScaleCrop(T.Augmentation):
+    """
+    等价于T.RandomFlip + T.ResizeScale + T.FixedSizeCrop：随机翻转、随机缩放后随机裁剪到固定尺寸，不足部分填充。
+    三步被合并为一个AffineCropTransform，放大时图像只需插值一次，多边形坐标也只需做一次矩阵乘法。
+    """
+
+    def __init__(
+        self,
+        min_scale,
+        max_scale,
+        target_height,
+        target_width,
+        horizontal=False,
+        vertical=False,
+        flip_prob=0.5,
+        pad_value=128.0,
+        seg_pad_value=0,
+    ):
+        super().__init__()
+        if horizontal and vertical:
+            raise ValueError("Cannot do both horiz and vert. Please use two Flip instead.")
+        self._init(locals())
+
+    def get_transform(self, image):
+        input_size = np.array(image.shape[:2])
+        # 与ResizeScale一致的缩放尺寸
+        random_scale = np.random.uniform(self.min_scale, self.max_scale)
+        target_size = np.multiply((self.target_height, self.target_width), random_scale)
+        output_scale = np.minimum(target_size[0] / input_size[0], target_size[1] / input_size[1])
+        scaled_size = np.round(np.multiply(input_size, output_scale)).astype(int)
+        # 与FixedSizeCrop一致的裁剪偏移
+        max_offset = np.maximum(scaled_size - (self.target_height, self.target_width), 0)
+        offset = np.round(np.multiply(max_offset, np.random.uniform(0.0, 1.0))).astype(int)
+
+        scale_y, scale_x = scaled_size / input_size
+        matrix = np.array([[scale_x, 0.0, -offset[1]], [0.0, scale_y, -offset[0]]], dtype=np.float64)
+        # 与RandomFlip一致：翻转作用于原图，x -> w - x（或y -> h - y），折算进同一个矩阵
+        if (self.horizontal or self.vertical) and np.random.uniform() < self.flip_prob:
+            axis = 0 if self.horizontal else 1
+            matrix[axis, 2] += matrix[axis, axis] * input_size[1 - axis]
+            matrix[axis, axis] = -matrix[axis, axis]
+        return AffineCropTransform(
+            matrix,
+            int(input_size[0]),
+            int(input_size[1]),
+            int(scaled_size[0]),
+            int(scaled_size[1]),
+            self.target_height,
+            self.target_width,
+            pad_value=self.pad_value,
+            seg_pad_value=self.seg_pad_value,
+        )
+
+
+def _fast_read_image(file_name, format=None):
+    """
+    使用OpenCV（libjpeg-turbo）读取图像，比detectron2中基于PIL的utils.read_image更快。
+    cv2.IMREAD_COLOR默认已按EXIF方向旋转图像；仅支持"RGB"/"BGR"格式，其余格式或读取失败时回退到utils.read_image。
+    """
+    if format not in ("RGB", "BGR"):
+        return utils.read_image(file_name, format=format)
+    image = cv2.imread(file_name, cv2.IMREAD_COLOR)
+    if image is None:
+        return utils.read_image(file_name, format=format)
+    if format == "RGB":
+        cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+    return image
+
+
+def polygons_to_boxes(segmentations):
+    """
+    args:
+        segmentations: list[list[ndarray]] 每个实例的多边形列表，与PolygonMasks.polygons格式一致
+    returns:
+        ndarray: (N, 4) float32，XYXY格式的边界框；没有多边形的实例返回全0框（会被filter_empty_instances过滤）
+    """
+    boxes = np.zeros((len(segmentations), 4), dtype=np.float32)
+    sizes = np.array([sum(len(p) for p in polygons) // 2 for polygons in segmentations], dtype=np.int64)
+    if sizes.sum() == 0:
+        return boxes
+    """将所有实例的多边形顶点拼接为一个(M, 2)数组，再按每个实例的起始偏移用reduceat一次性求最小/最大值。"""
+    points = np.concatenate([p for polygons in segmentations for p in polygons]).reshape(-1, 2)
+    nonempty = sizes > 0
+    offsets = (np.cumsum(sizes) - sizes)[nonempty]
+    boxes[nonempty, :2] = np.minimum.reduceat(points, offsets, axis=0)
+    boxes[nonempty, 2:] = np.maximum.reduceat(points, offsets, axis=0)
+    return boxes
+
+
+@torch.jit.script
+def _build_text_indices(classes: torch.Tensor, num_classes: int, num_queries: int) -> torch.Tensor:
+    """
+    为每个query生成描述文本对应的类别下标：按类别顺序依次排列每个实例的类别，超出num_queries的部分丢弃，
+    其余位置填-1（表示默认文本"an instance photo"）。
+    """
+    counts = torch.bincount(classes.to(torch.int64), minlength=num_classes)
+    class_ids = torch.repeat_interleave(torch.arange(counts.numel()), counts)[:num_queries]
+    indices = torch.full((num_queries,), -1, dtype=torch.int64)
+    indices[: class_ids.numel()] = class_ids
+    return indices
+
+
+def _to_output_tensor(tensor):
+    """
+    将mapper输出的tensor拷贝为连续内存。在主进程中（DataLoader的num_workers=0）且CUDA可用时，
+    直接拷贝到锁页内存，之后.to(device, non_blocking=True)可异步传输；
+    在DataLoader worker中，tensor会经共享内存传回主进程，锁页内存无效，因此只做普通的contiguous。
+    """
+    if not torch.cuda.is_available() or get_worker_info() is not None:
+        return tensor.contiguous()
+    pinned = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+    pinned.copy_(tensor)
+    return pinned
+
+
+def filter_annotations_outside_image(annos, transforms, image_size):
+    """
+    根据注释中原有的bbox，去掉变换（裁剪）后完全落在图像之外的注释，避免对其多边形做坐标变换和裁剪；
+    这些实例原本也会因为掩码为空而被filter_empty_instances过滤掉。
+    args:
+        annos: list[dict] 注释，包含"bbox"和"bbox_mode"
+        transforms: 作用于图像的TransformList
+        image_size: 变换后的图像尺寸(h, w)
+    returns:
+        list[dict]: 变换后bbox与图像有交集的注释
+    """
+    if not annos:
+        return annos
+    height, width = image_size
+    boxes = [BoxMode.convert(obj["bbox"], obj["bbox_mode"], BoxMode.XYXY_ABS) for obj in annos]
+    boxes = transforms.apply_box(np.array(boxes, dtype=np.float64))
+    keep = (boxes[:, 0] < width) & (boxes[:, 1] < height) & (boxes[:, 2] > 0) & (boxes[:, 3] > 0)
+    return [obj for obj, k in zip(annos, keep) if k]
+
+
+def _polygons_is_valid(points, sizes):
+    """
+    判断每个多边形是否为shapely意义下的合法多边形（如没有自相交）。
+    shapely>=2时一次向量化调用完成，否则逐个判断。
+    args:
+        points: (M, 2) 所有多边形顶点拼接后的坐标
+        sizes: (P,) 每个多边形的顶点数
+    """
+    valid = np.zeros(len(sizes), dtype=bool)
+    # 少于3个顶点无法构成多边形，交给shapely裁剪路径处理（与原流程行为一致）
+    enough = sizes >= 3
+    if not enough.any():
+        return valid
+    if hasattr(shapely, "is_valid"):
+        keep = np.repeat(enough, sizes)
+        rings = shapely.linearrings(points[keep], indices=np.repeat(np.arange(enough.sum()), sizes[enough]))
+        valid[enough] = shapely.is_valid(shapely.polygons(rings))
     else:
-        masks = torch.zeros((0, height, width), dtype=torch.uint8)
-    return masks
+        for i, poly in enumerate(np.split(points, np.cumsum(sizes)[:-1])):
+            valid[i] = enough[i] and shapely.geometry.Polygon(poly).is_valid
+    return valid
+
+
+def transform_annotations_to_instances(annos, transforms, image_size):
+    """
+    向量化地完成utils.transform_instance_annotations + utils.annotations_to_instances（仅支持多边形标注）。
+    先将注释由字典列表（AoS）整理为数组（SoA）：类别cls_ids[N]、每个实例的多边形数num_polygons[N]、
+    每个多边形的顶点数sizes[P]以及所有顶点拼接成的points[M, 2]；所有顶点只做一次坐标变换，
+    只有超出图像范围或不合法（如自相交，shapely的buffer(0)会修复或丢弃）的多边形才逐个用shapely裁剪，
+    其余多边形经过CropTransform.apply_polygons结果不变，直接保留。
+    args:
+        annos: list[dict] 非crowd的注释，"segmentation"为多边形列表
+        transforms: 作用于图像的TransformList
+        image_size: 变换后的图像尺寸(h, w)
+    returns:
+        Instances: 包含gt_classes、gt_masks（PolygonMasks）和gt_boxes
+    """
+    height, width = image_size
+    cls_ids = np.array([obj["category_id"] for obj in annos], dtype=np.int64)
+    polygons = [[np.asarray(p, dtype=np.float64) for p in obj["segmentation"] if len(p)] for obj in annos]
+    num_polygons = np.array([len(polys) for polys in polygons], dtype=np.int64)
+    polygons = [p for polys in polygons for p in polys]
+
+    segms = [[] for _ in annos]
+    if polygons:
+        sizes = np.array([len(p) // 2 for p in polygons], dtype=np.int64)
+        starts = np.cumsum(sizes) - sizes
+        points = transforms.apply_coords(np.concatenate(polygons).reshape(-1, 2))
+        """用reduceat一次性求出每个多边形变换后的范围，完全落在图像内且合法的多边形无需裁剪。"""
+        inside = (np.minimum.reduceat(points, starts, axis=0) >= 0).all(axis=1) & (
+            np.maximum.reduceat(points, starts, axis=0) <= [width, height]
+        ).all(axis=1)
+        inside[inside] = _polygons_is_valid(points[np.repeat(inside, sizes)], sizes[inside])
+        crop = T.CropTransform(0, 0, width, height)
+        owners = np.repeat(np.arange(len(annos)), num_polygons)
+        for owner, is_inside, poly in zip(owners, inside, np.split(points, starts[1:])):
+            if is_inside:
+                segms[owner].append(poly.reshape(-1))
+            else:
+                segms[owner].extend(p.reshape(-1) for p in crop.apply_polygons([poly]))
+
+    instances = Instances(image_size)
+    instances.gt_classes = torch.from_numpy(cls_ids)
+    instances.gt_masks = PolygonMasks(segms)
+    instances.gt_boxes = Boxes(torch.from_numpy(polygons_to_boxes(segms)))
+    return instances
 
 
 def build_transform_gen(cfg, is_train):
@@ -65,22 +490,17 @@ def build_transform_gen(cfg, is_train):
     min_scale = cfg.INPUT.MIN_SCALE
     max_scale = cfg.INPUT.MAX_SCALE
 
-    augmentation = []
-
-    if cfg.INPUT.RANDOM_FLIP != "none":
-        augmentation.append(
-            T.RandomFlip(
-                horizontal=cfg.INPUT.RANDOM_FLIP == "horizontal",
-                vertical=cfg.INPUT.RANDOM_FLIP == "vertical",
-            )
+    # 翻转、缩放与裁剪合并为一次仿射插值
+    augmentation = [
+        ResizeScaleCrop(
+            min_scale=min_scale,
+            max_scale=max_scale,
+            target_height=image_size,
+            target_width=image_size,
+            horizontal=cfg.INPUT.RANDOM_FLIP == "horizontal",
+            vertical=cfg.INPUT.RANDOM_FLIP == "vertical",
         )
-
-    augmentation.extend(
-        [
-            T.ResizeScale(min_scale=min_scale, max_scale=max_scale, target_height=image_size, target_width=image_size),
-            T.FixedSizeCrop(crop_size=(image_size, image_size)),
-        ]
-    )
+    ]
 
     return augmentation
 
@@ -119,6 +539,7 @@ class InstanceCOCOCustomNewBaselineDatasetMapper:
             crop_gen: crop augmentation
             tfm_gens: data augmentation
             image_format: an image format supported by :func:`detection_utils.read_image`.
+                "RGB" and "BGR" are decoded with OpenCV, see :func:`_fast_read_image`.
         """
         self.tfm_gens = tfm_gens
         logging.getLogger(__name__).info(
@@ -135,8 +556,13 @@ class InstanceCOCOCustomNewBaselineDatasetMapper:
             self.things.append(v)
         # 类别
         self.class_names = self.meta.thing_classes
+        self._num_classes = len(self.class_names)
+        self._prebuilt_strings = [f"a photo with a {name}" for name in self.class_names] + ["an instance photo"]
         self.text_tokenizer = Tokenize(SimpleTokenizer(), max_seq_len=max_seq_len)
         self.task_tokenizer = Tokenize(SimpleTokenizer(), max_seq_len=task_seq_len)
+        # 任务描述文本固定不变，只需分词一次
+        self._task = "The task is instance"
+        self._task_tokens = self.task_tokenizer(self._task)
 
     @classmethod
     def from_config(cls, cfg, is_train=True):
@@ -158,25 +584,11 @@ class InstanceCOCOCustomNewBaselineDatasetMapper:
         return ret
 
     # 实例分割任务的描述文本生成函数
-    def _get_texts(self, classes, num_class_obj):
+    def _get_texts(self, classes):
         """根据类ID生成描述文本。返回包含描述文本的列表。"""
-        classes = list(np.array(classes))
-        texts = ["an instance photo"] * self.num_queries
-
-        for class_id in classes:
-            cls_name = self.class_names[class_id]
-            num_class_obj[cls_name] += 1
-
-        num = 0
-        for i, cls_name in enumerate(self.class_names):
-            if num_class_obj[cls_name] > 0:
-                for _ in range(num_class_obj[cls_name]):
-                    if num >= len(texts):
-                        break
-                    texts[num] = f"a photo with a {cls_name}"
-                    num += 1
-
-        return texts
+        # 下标-1对应_prebuilt_strings末尾的默认文本
+        indices = _build_text_indices(classes, self._num_classes, self.num_queries)
+        return [self._prebuilt_strings[i] for i in indices.tolist()]
 
     def __call__(self, dataset_dict):
         """
@@ -186,26 +598,33 @@ class InstanceCOCOCustomNewBaselineDatasetMapper:
         Returns:
             dict: a format that builtin models in detectron2 accept
         """
-        dataset_dict = copy.deepcopy(dataset_dict)  # it will be modified by code below
-        image = utils.read_image(dataset_dict["file_name"], format=self.img_format)
+        # it will be modified by code below.
+        # 只浅拷贝外层字典：注释只会被读取（transform_annotations_to_instances不修改注释字典和其中的多边形），
+        # 因此无需对整个注释列表做代价高昂的deepcopy。
+        dataset_dict = dict(dataset_dict)
+        image = _fast_read_image(dataset_dict["file_name"], format=self.img_format)
         utils.check_image_size(dataset_dict, image)
 
         # TODO: get padding mask
         # by feeding a "segmentation mask" to the same transforms
-        padding_mask = np.ones(image.shape[:2])
+        # 二值掩码使用uint8而不是默认的float64，变换时按最近邻插值处理
+        padding_mask = np.ones(image.shape[:2], dtype=np.uint8)
 
         image, transforms = T.apply_transform_gens(self.tfm_gens, image)
         # the crop transformation has default padding value 0 for segmentation
         padding_mask = transforms.apply_segmentation(padding_mask)
-        padding_mask = ~padding_mask.astype(bool)
+        # 变换后的掩码只含0/1（最近邻插值，填充值为0），可直接按bool解释并原地取反，无需额外分配数组
+        padding_mask = padding_mask.view(bool)
+        np.logical_not(padding_mask, out=padding_mask)
         """转换图像格式：获取图像的形状（高度和宽度）。"""
         image_shape = image.shape[:2]  # h, w
 
         # Pytorch's dataloader is efficient on torch.Tensor due to shared-memory,
         # but not efficient on large generic data structures due to the use of pickle & mp.Queue.
         # Therefore it's important to use torch.Tensor.
-        dataset_dict["image"] = torch.as_tensor(np.ascontiguousarray(image.transpose(2, 0, 1)))
-        dataset_dict["padding_mask"] = torch.as_tensor(np.ascontiguousarray(padding_mask))
+        # warpAffine的输出已是连续的HWC数组：torch.from_numpy零拷贝，CHW只在_to_output_tensor中拷贝一次
+        dataset_dict["image"] = _to_output_tensor(torch.from_numpy(np.ascontiguousarray(image)).permute(2, 0, 1))
+        dataset_dict["padding_mask"] = _to_output_tensor(torch.from_numpy(np.ascontiguousarray(padding_mask)))
 
         """如果不是训练模式，移除注释并返回处理后的数据集字典。"""
         if not self.is_train:
@@ -215,21 +634,11 @@ class InstanceCOCOCustomNewBaselineDatasetMapper:
             return dataset_dict
 
         if "annotations" in dataset_dict:
-            # USER: Modify this if you want to keep them for some reason.
-            for anno in dataset_dict["annotations"]:
-                anno.pop("keypoints", None)
-
             # USER: Implement additional transformations if you have other types of data
-            # 对每个注释应用变换，并过滤掉iscrowd属性为1的注释。
-            annos = [
-                utils.transform_instance_annotations(obj, transforms, image_shape)
-                for obj in dataset_dict.pop("annotations")
-                if obj.get("iscrowd", 0) == 0
-            ]
-            # 将注释转换为实例对象。
-            instances = utils.annotations_to_instances(annos, image_shape)
-            # 从实例掩码中获取边界框。
-            instances.gt_boxes = instances.gt_masks.get_bounding_boxes()
+            # 过滤掉iscrowd属性为1以及裁剪后落在图像之外的注释，并将其余注释整体变换为实例对象（含由多边形计算的边界框）。
+            annos = [obj for obj in dataset_dict.pop("annotations") if obj.get("iscrowd", 0) == 0]
+            annos = filter_annotations_outside_image(annos, transforms, image_shape)
+            instances = transform_annotations_to_instances(annos, transforms, image_shape)
             # Need to filter empty instances first (due to augmentation)
             instances = utils.filter_empty_instances(instances)
             # Generate masks from polygon
@@ -238,18 +647,14 @@ class InstanceCOCOCustomNewBaselineDatasetMapper:
             if hasattr(instances, "gt_masks"):
                 gt_masks = instances.gt_masks
                 gt_masks = convert_coco_poly_to_mask(gt_masks.polygons, h, w)  # 将COCO格式的多边形转换为掩码。
-                instances.gt_masks = gt_masks
-
-            num_class_obj = {}
-            for name in self.class_names:
-                num_class_obj[name] = 0
+                instances.gt_masks = _to_output_tensor(gt_masks)
 
-            task = "The task is instance"
-            text = self._get_texts(instances.gt_classes, num_class_obj)
+            text = self._get_texts(instances.gt_classes)
 
             dataset_dict["instances"] = instances
             dataset_dict["orig_shape"] = image_shape
-            dataset_dict["task"] = task
+            dataset_dict["task"] = self._task
+            dataset_dict["task_tokens"] = self._task_tokens
             dataset_dict["text"] = text
             dataset_dict["thing_ids"] = self.things
 
@@ -1,9 +1,67 @@
+import functools
+import mmap
 import os
+from unittest import mock
+
 import cv2
+import pycocotools.coco
 from detectron2.utils.visualizer import Visualizer
 from detectron2.data import MetadataCatalog, build_detection_train_loader, DatasetCatalog
 from detectron2.data.datasets import load_coco_json, register_coco_instances
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class _OrjsonCOCO(pycocotools.coco.COCO):
+    """用orjson解析内存映射的json文件，替代pycocotools中基于json模块的解析，其余逻辑与COCO一致"""
+
+    def __init__(self, annotation_file=None):
+        super().__init__()
+        if annotation_file is not None:
+            with open(annotation_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                with memoryview(mm) as buf:
+                    dataset = orjson.loads(buf)
+            assert type(dataset) == dict, "annotation file format {} not supported".format(type(dataset))
+            self.dataset = dataset
+            self.createIndex()
+
+
+def _load(json_file, image_root, name=None):
+    """与load_coco_json相同，orjson可用时改用orjson + mmap解析json"""
+    if orjson is None:
+        return load_coco_json(json_file, image_root, name)
+    # load_coco_json内部通过pycocotools.coco.COCO读取json，这里临时替换为orjson + mmap的实现
+    with mock.patch.object(pycocotools.coco, "COCO", _OrjsonCOCO):
+        return load_coco_json(json_file, image_root, name)
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_load(json_file, image_root, name=None):
+    """同一进程内每个json只解析一次，重复构建数据集时直接复用已解析的结果"""
+    return _load(json_file, image_root, name)
+
+
+def _load_coco_json(json_file, image_root, name=None, cache=False):
+    """
+    加载COCO格式的数据集。
+    cache=True时解析结果常驻主进程内存，再次加载时跳过json解析，适合每次评估都会重新构建的验证集；
+    返回逐条记录（及其注释）的拷贝，调用方原地修改记录（如load_proposals_into_dataset添加字段）不会污染缓存。
+    训练集不要缓存：detectron2的DatasetFromList会将列表序列化，以免fork出的DataLoader worker因gc和引用计数
+    写入而复制这些对象所在的内存页；常驻的缓存列表恰好会抵消这一点，反而增加内存占用。
+    """
+    if not cache:
+        return _load(json_file, image_root, name)
+    records = []
+    for record in _cached_load(json_file, image_root, name):
+        record = dict(record)
+        if "annotations" in record:
+            record["annotations"] = [dict(anno) for anno in record["annotations"]]
+        records.append(record)
+    return records
+
 
 class Register:
     """用于注册自己的数据集"""
@@ -27,6 +85,8 @@ class Register:
             "coco_landslide_train": (self.TRAIN_PATH, self.TRAIN_JSON),
             "coco_landslide_val": (self.VAL_PATH, self.VAL_JSON),
         }
+        # 每次评估都会重新加载的子集，缓存解析结果（见_load_coco_json）
+        self.CACHED_SPLITS = {"coco_landslide_val"}
 
     def register_dataset(self):
         """
@@ -34,22 +94,24 @@ class Register:
         注册数据集（这一步就是将自定义数据集注册进Detectron2）
         """
         for key, (image_root, json_file) in self.PREDEFINED_SPLITS_DATASET.items():
-            self.register_dataset_instances(name=key, json_file=json_file, image_root=image_root)
+            self.register_dataset_instances(
+                name=key, json_file=json_file, image_root=image_root, cache=key in self.CACHED_SPLITS
+            )
 
     @staticmethod
-    def register_dataset_instances(name, json_file, image_root):
+    def register_dataset_instances(name, json_file, image_root, cache=False):
         """复现了register_coco_instances函数
         purpose: register datasets to DatasetCatalog,
                  register metadata to MetadataCatalog and set attribute
         注册数据集实例，加载数据集中的对象实例
         """
-        DatasetCatalog.register(name, lambda: load_coco_json(json_file, image_root, name))
+        DatasetCatalog.register(name, lambda: _load_coco_json(json_file, image_root, name, cache=cache))
         MetadataCatalog.get(name).set(json_file=json_file, image_root=image_root, evaluator_type="coco")
 
     def plain_register_dataset(self):
         """修改注册数据集和元数据"""
         # 训练集 233333333
-        DatasetCatalog.register("coco_Jiuzhai_train", lambda: load_coco_json(self.TRAIN_JSON, self.TRAIN_PATH))
+        DatasetCatalog.register("coco_Jiuzhai_train", lambda: _load_coco_json(self.TRAIN_JSON, self.TRAIN_PATH))
         MetadataCatalog.get("coco_Jiuzhai_train").set(
             thing_classes=self.CLASS_NAMES,  # 可以选择开启，但是不能显示中文，这里需要注意，中文的话最好关闭
             evaluator_type="coco",  # 指定评估方式
@@ -59,7 +121,7 @@ class Register:
 
         # DatasetCatalog.register("coco_my_val", lambda: load_coco_json(VAL_JSON, VAL_PATH, "coco_2017_val"))
         # 验证/测试集 23333333
-        DatasetCatalog.register("coco_Jiuzhai_val", lambda: load_coco_json(self.VAL_JSON, self.VAL_PATH))
+        DatasetCatalog.register("coco_Jiuzhai_val", lambda: _load_coco_json(self.VAL_JSON, self.VAL_PATH, cache=True))
         MetadataCatalog.get("coco_Jiuzhai_val").set(
             thing_classes=self.CLASS_NAMES,  # 可以选择开启，但是不能显示中文，这里需要注意，中文的话最好关闭
             evaluator_type="coco",  # 指定评估方式
@@ -252,6 +252,7 @@ class OneFormer(nn.Module):
                 For now, each item in the list is a dict that contains:
                    * "image": Tensor, image in (C, H, W) format.
                    * "instances": per-region ground truth
+                   * "task_tokens" (optional): Tensor, the "task" text already tokenized by the mapper.
                    * Other information that's included in the original dicts, such as:
                      "height", "width" (int): the output resolution of the model (may be different
                      from input resolution), used in inference.
@@ -269,11 +270,17 @@ class OneFormer(nn.Module):
                     segments_info (list[dict]): Describe each segment in `panoptic_seg`.
                         Each dict contains keys "id", "category_id", "isthing".
         """
-        images = [x["image"].to(self.device) for x in batched_inputs]
+        images = [x["image"].to(self.device, non_blocking=True) for x in batched_inputs]
         images = [(x - self.pixel_mean) / self.pixel_std for x in images]
         images = ImageList.from_tensors(images, self.size_divisibility)
 
-        tasks = torch.cat([self.task_tokenizer(x["task"]).to(self.device).unsqueeze(0) for x in batched_inputs], dim=0)
+        tasks = torch.cat(
+            [
+                (x["task_tokens"] if "task_tokens" in x else self.task_tokenizer(x["task"])).to(self.device).unsqueeze(0)
+                for x in batched_inputs
+            ],
+            dim=0,
+        )
         tasks = self.task_mlp(tasks.float())
 
         features = self.backbone(images.tensor)